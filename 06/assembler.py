@@ -1,4 +1,14 @@
 import argparse
+import array
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import mmap
+import os
+import pickle
+import sys
+from typing import Iterable, Iterator
 
 
 class Parsed:
@@ -14,8 +24,15 @@ class SIGFINISH(Parsed):
 
 
 class C(Parsed):
-    def __init__(self, content):
-        super().__init__(self.parse(content))
+    def to_int(self):
+        word = map_c_inst.get(self.content)
+        if word is None:
+            dest, comp, jump = self.parse(self.content)
+            word = 0xE000 | self.comp(comp) << 6 | self.dest(dest) << 3 | map_jump_bits[jump]
+        return word
+
+    def to_bin(self):
+        return to_bin(self.to_int())
 
     def parse(self, content):
         eq = content.find("=")
@@ -32,33 +49,11 @@ class C(Parsed):
             jump = content[sc + 1:]
         return dest, comp, jump
 
-    def to_bin(self):
-        dest, comp, jump = self.content
-        return "111" + self.comp(comp) + self.dest(dest) + self.jump(jump)
-
     def comp(self, arg):
-        if arg in code_prefix:
-            return "1" + map_comp[code_prefix[arg]]
-        else:
-            return "0" + map_comp[arg]
-
-    def jump(self, arg):
-        return map_jump[arg]
+        return map_comp_bits[arg]
 
     def dest(self, arg):
-        if "A" in arg:
-            ret = "1"
-        else:
-            ret = "0"
-        if "D" in arg:
-            ret += "1"
-        else:
-            ret += "0"
-        if "M" in arg:
-            ret += "1"
-        else:
-            ret += "0"
-        return ret
+        return ("A" in arg) << 2 | ("D" in arg) << 1 | ("M" in arg)
 
 
 class A(Parsed):
@@ -69,8 +64,11 @@ class A(Parsed):
     def is_symbol(self):
         return not self.content.isdigit()
 
+    def to_int(self):
+        return int(self.content)
+
     def to_bin(self):
-        return bin(int(self.content))[2:].zfill(16)
+        return to_bin(self.to_int())
 
 
 class L(Parsed):
@@ -83,38 +81,56 @@ class L(Parsed):
 
 class Parser:
     def __init__(self, input_file):
-        self.f = open(input_file, "r")
-        self.inst_str = None
-
-    def has_moreline(self):
-        self.inst_str = self.f.readline()
-        return bool(self.inst_str)
+        self.lines = iter_instructions(input_file)
 
     def advance(self):
-        if self.has_moreline():
-            self.remove_comment(self.inst_str)
-            if self.inst_str == "":
-                self.advance()
-            return self.parse(self.inst_str)
-        else:
-            self.f.close()
+        inst_str = next(self.lines, None)
+        if inst_str is None:
             return SIGFINISH()
-
-    def remove_comment(self, line):
-        s = line.find("//")
-        if s > -1:
-            line = line[:s]
-        self.inst_str = line.strip()
+        return self.parse(inst_str)
 
     def parse(self, inst_str):
-        if inst_str.startswith("@"):
-            return A(inst_str)
-        elif inst_str.startswith("(") and inst_str.endswith(")"):
-            return L(inst_str)
-        elif "=" in inst_str or ";" in inst_str:
-            return C(inst_str)
-        else:
-            raise NotImplementedError()
+        return parse_inst(inst_str)
+
+
+def iter_instructions(input_file, start=0, end=None, block_size=1 << 20):
+    # reads [start, end) in large blocks and yields the instruction text of
+    # every line that is not blank or comment-only.
+    with open(input_file, "rb") as f:
+        f.seek(start)
+        left = os.fstat(f.fileno()).st_size - start if end is None else end - start
+        tail = b""
+        while True:
+            block = f.read(min(block_size, left)) if left > 0 else b""
+            left -= len(block)
+            buf = tail + block
+            # only whole lines are decoded, the rest waits for the next block
+            cut = buf.rfind(b"\n") + 1 if block else len(buf)
+            tail = buf[cut:]
+            for line in buf[:cut].decode().splitlines():
+                inst_str = remove_comment(line)
+                if inst_str:
+                    yield inst_str
+            if not block:
+                break
+
+
+def remove_comment(line):
+    s = line.find("//")
+    if s > -1:
+        line = line[:s]
+    return line.strip()
+
+
+def parse_inst(inst_str):
+    if inst_str.startswith("@"):
+        return A(inst_str)
+    elif inst_str.startswith("(") and inst_str.endswith(")"):
+        return L(inst_str)
+    elif "=" in inst_str or ";" in inst_str:
+        return C(inst_str)
+    else:
+        raise NotImplementedError()
 
 
 map_jump = {
@@ -146,6 +162,9 @@ map_comp = {
     "A-D": "000111",
     "D&A": "000000",
     "D|A": "010101",
+    "A+D": "000010",
+    "A&D": "000000",
+    "A|D": "010101",
 }
 code_prefix = {
     "M": "A",
@@ -158,8 +177,73 @@ code_prefix = {
     "M-D": "A-D",
     "D&M": "D&A",
     "D|M": "D|A",
+    "M+D": "A+D",
+    "M&D": "A&D",
+    "M|D": "A|D",
 }
 
+map_jump_bits = {k: int(v, 2) for k, v in map_jump.items()}
+map_comp_bits = {k: int(v, 2) for k, v in map_comp.items()}
+map_comp_bits.update({k: 0x40 | map_comp_bits[v] for k, v in code_prefix.items()})
+map_dest_bits = {"".join(p): ("A" in p) << 2 | ("D" in p) << 1 | ("M" in p)
+                 for n in range(1, 4) for p in itertools.permutations("ADM", n)}
+
+
+def _build_c_table():
+    # every legal "dest=comp;jump" spelling -> its 16-bit word
+    table = {}
+    for comp, c in map_comp_bits.items():
+        for dest, d in [(None, 0)] + list(map_dest_bits.items()):
+            for jump, j in map_jump_bits.items():
+                if dest is None and jump == "null":
+                    continue
+                inst = comp if dest is None else dest + "=" + comp
+                if jump != "null":
+                    inst += ";" + jump
+                table[inst] = 0xE000 | c << 6 | d << 3 | j
+    return table
+
+
+map_c_inst = _build_c_table()
+
+
+def to_bin(word):
+    return format(word, "016b")
+
+
+def encode_hack(word):
+    return (to_bin(word) + "\n").encode()
+
+
+def encode_bin(word):
+    return word.to_bytes(2, "little")
+
+
+# format -> (file suffix, fixed-width encoder of a single word)
+output_formats = {
+    "hack": (".hack", encode_hack),
+    "bin": (".bin", encode_bin),
+}
+
+
+def load_rom(path):
+    # maps a packed little-endian .bin image and returns it as a read-only
+    # memoryview of uint16 words without copying it.
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size % 2:
+            raise Exception(f"{path}: {size} bytes is not a whole number of 16-bit words, truncated file?")
+        if size == 0:
+            return memoryview(array.array("H"))
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if sys.byteorder == "big":
+        words = array.array("H", mm)
+        words.byteswap()
+        mm.close()
+        return memoryview(words)
+    return memoryview(mm).cast("H")
+
+
 predefined_syms = {
     "R0": 0,
     "R1": 1,
@@ -188,6 +272,16 @@ predefined_syms = {
 }
 
 
+MAX_A_VALUE = 32767  # an A-instruction holds 15 bits
+
+
+def check_address(symbol, address):
+    if address > MAX_A_VALUE:
+        raise Exception(f"program does not fit in ROM: {symbol} is at {address}, "
+                        f"A-instructions only reach {MAX_A_VALUE}")
+    return address
+
+
 class SymbolTable:
     def __init__(self):
         self._table = {}
@@ -203,55 +297,720 @@ class SymbolTable:
         return self._table[symbol]
 
 
+KIND_A = 0  # value: the constant
+KIND_A_SYM = 1  # sym: the symbol, value: its address once resolved
+KIND_C = 2  # value: the encoded word
+KIND_L = 3  # sym: the label
+
+
+class Program:
+    # instructions as parallel typed arrays instead of one object each.
+    # symbol names are interned and referred to by index.
+    def __init__(self):
+        self.kinds = array.array("B")
+        self.values = array.array("I")
+        self.syms = array.array("i")
+        self.symbols = []
+        self._sym_idx = {}
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def intern(self, symbol):
+        idx = self._sym_idx.get(symbol)
+        if idx is None:
+            idx = self._sym_idx[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+        return idx
+
+    def append(self, kind, value=0, sym=-1):
+        self.kinds.append(kind)
+        self.values.append(value)
+        self.syms.append(sym)
+
+    def add(self, inst_str):
+        if inst_str.startswith("@"):
+            content = inst_str[1:]
+            if content.isdigit():
+                self.append(KIND_A, int(content))
+            else:
+                self.append(KIND_A_SYM, 0, self.intern(content))
+        elif inst_str.startswith("(") and inst_str.endswith(")"):
+            self.append(KIND_L, 0, self.intern(inst_str[1:-1]))
+        else:
+            word = map_c_inst.get(inst_str)
+            if word is None:
+                word = parse_inst(inst_str).to_int()
+            self.append(KIND_C, word)
+
+    def extend(self, lines):
+        for inst_str in lines:
+            self.add(inst_str)
+
+    def allocate(self, sym_table, var_addr):
+        # variables in order of first use, done before any pass can drop a
+        # reference. returns the next free address.
+        labels = {sym for kind, sym in zip(self.kinds, self.syms) if kind == KIND_L}
+        symbols = self.symbols
+        for kind, sym in zip(self.kinds, self.syms):
+            if kind == KIND_A_SYM and sym not in labels and not sym_table.contains(symbols[sym]):
+                sym_table.add_entry(symbols[sym], var_addr)
+                var_addr += 1
+        return var_addr
+
+    def bind_labels(self, sym_table):
+        # pass one: label addresses, returns the number of words
+        addr = 0
+        symbols = self.symbols
+        for kind, sym in zip(self.kinds, self.syms):
+            if kind == KIND_L:
+                sym_table.add_entry(symbols[sym], addr)
+            else:
+                addr += 1
+        return addr
+
+    def resolve(self, sym_table, var_addr):
+        # pass two: symbol addresses, new variables are allocated from
+        # var_addr in order of first use. returns the next free address.
+        values = self.values
+        symbols = self.symbols
+        for i, (kind, sym) in enumerate(zip(self.kinds, self.syms)):
+            if kind == KIND_A_SYM:
+                symbol = symbols[sym]
+                if not sym_table.contains(symbol):
+                    sym_table.add_entry(symbol, var_addr)
+                    var_addr += 1
+                values[i] = check_address(symbol, sym_table.get_address(symbol))
+        return var_addr
+
+    def compact(self, keep):
+        # drops every instruction whose keep flag is 0
+        for name in ("kinds", "values", "syms"):
+            old = getattr(self, name)
+            setattr(self, name, array.array(old.typecode, itertools.compress(old, keep)))
+
+    def words(self):
+        words = array.array("I")
+        for kind, value in zip(self.kinds, self.values):
+            if kind != KIND_L:
+                words.append(value)
+        return words
+
+
+DEST_M = 1
+DEST_D = 2
+DEST_A = 4
+COMP_A = map_comp_bits["A"]
+COMP_D = map_comp_bits["D"]
+COMP_M = map_comp_bits["M"]
+# registers read by every comp field
+comp_reads = {bits: set(comp) & set("ADM") for comp, bits in map_comp_bits.items()}
+
+
+def peephole(program):
+    # tracks what A and D are known to hold inside a basic block (from a
+    # label or the instruction after a jump up to the next ones) and drops
+    # instructions that provably change nothing: A loads of the value
+    # already in A, D=M / D=A / M=D when D already holds that value, and A
+    # loads or D-only writes that are overwritten before anything reads
+    # them. keys are ("c", value) or ("s", symbol); keys that differ are
+    # assumed to alias in memory. returns the number of removed words.
+    keep = bytearray(b"\x01") * len(program)
+    a = None  # key of the value in A
+    d = None  # ("a", key): D == key, ("m", key): D == RAM[key]
+    unread_a = None  # index of the last A load nothing has used yet
+    unread_d = None  # index of the last plain D write nothing has read yet
+    for i, (kind, value, sym) in enumerate(zip(program.kinds, program.values, program.syms)):
+        if kind == KIND_L:
+            a = d = unread_a = unread_d = None
+            continue
+        if kind != KIND_C:
+            key = ("c", value) if kind == KIND_A else ("s", sym)
+            if key == a:
+                keep[i] = 0
+                continue
+            if unread_a is not None:
+                keep[unread_a] = 0
+            a = key
+            unread_a = i
+            continue
+
+        comp = (value >> 6) & 0x7F
+        dest = (value >> 3) & 7
+        jump = value & 7
+        if not jump and a is not None:
+            if dest == DEST_D and (comp == COMP_M and d == ("m", a) or comp == COMP_A and d == ("a", a)):
+                keep[i] = 0
+                continue
+            if dest == DEST_M and comp == COMP_D and d == ("m", a):
+                keep[i] = 0
+                continue
+
+        reads = comp_reads[comp]
+        if "A" in reads or "M" in reads or dest & DEST_M or jump:
+            unread_a = None
+        if "D" in reads:
+            unread_d = None
+        if dest & DEST_A and unread_a is not None:
+            keep[unread_a] = 0
+            unread_a = None
+        if dest & DEST_D:
+            if unread_d is not None:
+                keep[unread_d] = 0
+            unread_d = i if dest == DEST_D and not jump else None
+
+        if dest & DEST_M:
+            if d is not None and d[0] == "m":
+                d = None
+            if comp == COMP_D and a is not None:
+                d = ("m", a)
+        if dest & DEST_D:
+            if a is None:
+                d = None
+            elif comp == COMP_M or dest & DEST_M:
+                d = ("m", a)
+            elif comp == COMP_A:
+                d = ("a", a)
+            else:
+                d = None
+        if dest & DEST_A:
+            a = None
+        if jump:
+            a = d = unread_a = unread_d = None
+    program.compact(keep)
+    return len(keep) - sum(keep)
+
+
+JMP = map_c_inst["0;JMP"]
+
+
+def thread_jumps(program):
+    # a jump to a label whose first instruction is "@Y 0;JMP" goes to Y
+    # directly. conditional jumps are only retargeted when the fall-through
+    # path loads A before using it. returns the number of threaded jumps.
+    kinds, values, syms = program.kinds, program.values, program.syms
+    n = len(kinds)
+    entry = {}
+    nxt = n
+    for i in range(n - 1, -1, -1):
+        if kinds[i] == KIND_L:
+            entry[syms[i]] = nxt
+        else:
+            nxt = i
+    threaded = 0
+    for i in range(1, n):
+        if kinds[i] != KIND_C or not values[i] & 7 or kinds[i - 1] != KIND_A_SYM:
+            continue
+        if values[i] & 7 != 7 and (i + 1 == n or kinds[i + 1] not in (KIND_A, KIND_A_SYM)):
+            continue
+        target = syms[i - 1]
+        seen = {target}
+        while target in entry:
+            t = entry[target]
+            if t + 1 >= n or kinds[t] != KIND_A_SYM or kinds[t + 1] != KIND_C or values[t + 1] != JMP:
+                break
+            if syms[t] in seen:
+                break
+            target = syms[t]
+            seen.add(target)
+        if target != syms[i - 1]:
+            syms[i - 1] = target
+            threaded += 1
+    return threaded
+
+
+def remove_unreachable(program, keep_labels=False):
+    # code after an unconditional jump is dead up to the next label that is
+    # still referenced, labels nothing refers to are dropped. repeated until
+    # nothing changes. with keep_labels every label counts as referenced,
+    # for modules whose labels may be used by others. returns the number
+    # of removed words.
+    removed = 0
+    while True:
+        kinds, values, syms = program.kinds, program.values, program.syms
+        refs = {sym for kind, sym in zip(kinds, syms) if kind == KIND_A_SYM or keep_labels}
+        keep = bytearray(len(kinds))
+        live = True
+        for i, (kind, value, sym) in enumerate(zip(kinds, values, syms)):
+            if kind == KIND_L:
+                if sym in refs:
+                    live = True
+                    keep[i] = 1
+                continue
+            keep[i] = live
+            if not live:
+                removed += 1
+            elif kind == KIND_C and value & 7 == 7:
+                live = False
+        if all(keep):
+            return removed
+        program.compact(keep)
+
+
+def optimize_program(program, level, keep_labels=False):
+    # level 1: peephole, level 2: jump threading and dead code first.
+    # returns what each pass did, the CLI prints it
+    counts = {}
+    if level >= 2:
+        counts["threaded"] = thread_jumps(program)
+        counts["unreachable"] = remove_unreachable(program, keep_labels)
+    counts["peephole"] = peephole(program)
+    return counts
+
+
+def optimize_report(counts):
+    parts = []
+    if "threaded" in counts:
+        parts.append(f"jump threading: {counts['threaded']} jumps threaded, "
+                     f"{counts['unreachable']} unreachable words removed")
+    parts.append(f"peephole: {counts['peephole']} words removed")
+    parts.append(f"{counts.get('unreachable', 0) + counts['peephole']} ROM words saved")
+    return "; ".join(parts)
+
+
+def split_chunks(input_file, n):
+    # byte ranges of roughly equal size, each ending on a line boundary
+    size = os.path.getsize(input_file)
+    bounds = []
+    start = 0
+    with open(input_file, "rb") as f:
+        for i in range(1, n):
+            pos = max(size * i // n, start)
+            f.seek(pos)
+            f.readline()
+            end = min(f.tell(), size)
+            bounds.append((start, end))
+            start = end
+    bounds.append((start, size))
+    return bounds
+
+
+def read_chunk(input_file, start, end):
+    for inst_str in iter_instructions(input_file, start, end):
+        yield parse_inst(inst_str)
+
+
+def scan_chunk(input_file, start, end):
+    # labels at chunk-relative addresses, instruction count and symbols in
+    # order of first use
+    labels = []
+    symbols = {}
+    n = 0
+    for s in read_chunk(input_file, start, end):
+        if isinstance(s, L):
+            labels.append((s.content, n))
+            continue
+        if isinstance(s, A) and s.is_symbol:
+            symbols[s.content] = None
+        n += 1
+    return labels, n, list(symbols)
+
+
+def encode_chunk(input_file, start, end, table):
+    words = array.array("I")
+    for s in read_chunk(input_file, start, end):
+        if isinstance(s, L):
+            continue
+        if isinstance(s, A) and s.is_symbol:
+            words.append(check_address(s.content, table[s.content]))
+        else:
+            words.append(s.to_int())
+    return words
+
+
+CACHE_VERSION = 1
+
+
+def split_regions(lines):
+    # a new region starts at every label definition
+    regions = [[]]
+    for inst_str in lines:
+        if inst_str.startswith("(") and regions[-1]:
+            regions.append([])
+        regions[-1].append(inst_str)
+    return regions
+
+
+def encode_region(lines):
+    # (labels as (name, offset), words with 0 for symbols, refs as (offset, name))
+    program = Program()
+    program.extend(lines)
+    labels = []
+    refs = []
+    words = array.array("I")
+    for kind, value, sym in zip(program.kinds, program.values, program.syms):
+        if kind == KIND_L:
+            labels.append((program.symbols[sym], len(words)))
+            continue
+        if kind == KIND_A_SYM:
+            refs.append((len(words), program.symbols[sym]))
+        words.append(value)
+    return labels, words, refs
+
+
+def load_cache(cache_path):
+    try:
+        with open(cache_path, "rb") as f:
+            cache = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    if cache.get("version") != CACHE_VERSION:
+        return None
+    return cache
+
+
+def clean_lines(lines):
+    for line in lines:
+        inst_str = remove_comment(line)
+        if inst_str:
+            yield inst_str
+
+
+def no_hook(name):
+    pass
+
+
+def assemble_program(program, sym_table, var_addr=16, optimize=0, on_pass=no_hook):
+    # returns (number of words, next free variable address, optimize_program
+    # counts or None). on_pass(name) is called after every pass,
+    # benchmark.py times them with it.
+    var_addr = program.allocate(sym_table, var_addr)
+    on_pass("allocate")
+    counts = None
+    if optimize:
+        counts = optimize_program(program, optimize)
+        on_pass("optimize")
+    line_no = program.bind_labels(sym_table)
+    on_pass("bind_labels")
+    var_addr = program.resolve(sym_table, var_addr)
+    on_pass("resolve")
+    return line_no, var_addr, counts
+
+
+def assemble_iter(lines: Iterable[str], optimize=0, on_pass=no_hook, counts=None) -> Iterator[int]:
+    # source lines in, machine words out. only the compact IR is kept. the
+    # optimize_program counts are added to counts if it is given.
+    program = Program()
+    program.extend(clean_lines(lines))
+    on_pass("parse")
+    _, _, optimized = assemble_program(program, SymbolTable(), optimize=optimize, on_pass=on_pass)
+    if counts is not None and optimized:
+        counts.update(optimized)
+    for kind, value in zip(program.kinds, program.values):
+        if kind != KIND_L:
+            yield value
+
+
+def assemble(lines: Iterable[str], optimize=0, on_pass=no_hook, counts=None) -> array.array:
+    words = array.array("H", assemble_iter(lines, optimize, on_pass, counts))
+    on_pass("encode")
+    return words
+
+
+def save(words, write_path, fmt="hack"):
+    if fmt == "bin":
+        words = array.array("H", words)
+        if sys.byteorder == "big":
+            words.byteswap()
+        with open(write_path, "wb") as g:
+            g.write(words)
+        return
+    with open(write_path + "", "w") as g:
+        for i in words:
+            g.write(to_bin(i) + "\n")
+
+
+OBJECT_VERSION = 1
+
+
+def compile_object(lines, optimize=0, counts=None):
+    # relocatable module: words with label addresses relative to the module
+    # start (listed in relocs) and 0 for symbols defined elsewhere (listed
+    # in externs). uses keeps the order of first use before optimisation,
+    # which is the order the linker allocates variables in. the
+    # optimize_program counts are added to counts if it is given.
+    program = Program()
+    program.extend(clean_lines(lines))
+    symbols = program.symbols
+    local = {symbols[sym] for kind, sym in zip(program.kinds, program.syms) if kind == KIND_L}
+    uses = {}
+    for kind, sym in zip(program.kinds, program.syms):
+        if kind == KIND_A_SYM and symbols[sym] not in local and symbols[sym] not in predefined_syms:
+            uses[symbols[sym]] = None
+    if optimize:
+        optimized = optimize_program(program, optimize, keep_labels=True)
+        if counts is not None:
+            counts.update(optimized)
+
+    labels = {}
+    words = []
+    for kind, value, sym in zip(program.kinds, program.values, program.syms):
+        if kind == KIND_L:
+            labels[symbols[sym]] = len(words)
+        else:
+            words.append(value)
+    relocs = []
+    externs = []
+    pos = 0
+    for kind, sym in zip(program.kinds, program.syms):
+        if kind == KIND_L:
+            continue
+        if kind == KIND_A_SYM:
+            symbol = symbols[sym]
+            if symbol in labels:
+                relocs.append(pos)
+                words[pos] = labels[symbol]
+            elif symbol in predefined_syms:
+                words[pos] = predefined_syms[symbol]
+            else:
+                externs.append((pos, symbol))
+        pos += 1
+    return {"version": OBJECT_VERSION, "words": words, "labels": labels,
+            "relocs": relocs, "externs": externs, "uses": list(uses)}
+
+
+def compile_file(read_path, optimize=0):
+    # returns (object path, optimize_program counts or None)
+    write_path = read_path.replace(".asm", ".hobj")
+    counts = {}
+    with open(read_path) as f:
+        obj = compile_object(f, optimize, counts)
+    with open(write_path, "w") as g:
+        json.dump(obj, g)
+    return write_path, counts or None
+
+
+def read_object(path):
+    with open(path) as f:
+        obj = json.load(f)
+    if obj.get("version") != OBJECT_VERSION:
+        raise Exception(f"unsupported object file: {path}")
+    return obj
+
+
+def link(objects):
+    # module bases are a prefix sum of the sizes, then every module is
+    # copied once while its relocs and externs are patched.
+    table = dict(predefined_syms)
+    base = 0
+    bases = []
+    for obj in objects:
+        bases.append(base)
+        for label, offset in obj["labels"].items():
+            if label in table:
+                raise Exception(f"label defined more than once: {label}")
+            table[label] = base + offset
+        base += len(obj["words"])
+    var_addr = 16
+    for obj in objects:
+        for symbol in obj["uses"]:
+            if symbol not in table:
+                table[symbol] = var_addr
+                var_addr += 1
+
+    words = array.array("H")
+    for obj, base in zip(objects, bases):
+        module = array.array("I", obj["words"])  # local offsets may not fit yet
+        for pos in obj["relocs"]:
+            module[pos] = check_address("a local label", module[pos] + base)
+        for pos, symbol in obj["externs"]:
+            module[pos] = check_address(symbol, table[symbol])
+        words.extend(array.array("H", module))
+    return words
+
+
 class Assembler:
     def __init__(self, input_file):
+        self.input_file = input_file
         self.parser = Parser(input_file)
         self.inst = []
         self.sym_table = SymbolTable()
         self.line_no = 0
         self.var_addr = 16
+        self.counts = None
+
+    def generate(self, optimize=0):
+        self.program = Program()
+        self.program.extend(iter_instructions(self.input_file))
+        self.line_no, self.var_addr, self.counts = assemble_program(self.program, self.sym_table,
+                                                                    self.var_addr, optimize)
+        self.inst = self.program.words()
+
+    def generate_parallel(self, jobs):
+        # pass one scans the chunks for labels, the offsets are fixed up with
+        # a prefix sum. variables are allocated here, walking the chunks in
+        # order, so they keep the serial first-use order.
+        bounds = split_chunks(self.input_file, jobs)
+        paths = [self.input_file] * len(bounds)
+        starts = [b[0] for b in bounds]
+        ends = [b[1] for b in bounds]
+        with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+            scanned = list(pool.map(scan_chunk, paths, starts, ends))
+            symbols = []
+            for labels, n, syms in scanned:
+                for label, idx in labels:
+                    self.sym_table.add_entry(label, self.line_no + idx)
+                self.line_no += n
+                symbols.append(syms)
+            for syms in symbols:
+                for symbol in syms:
+                    if not self.sym_table.contains(symbol):
+                        self.sym_table.add_entry(symbol, self.var_addr)
+                        self.var_addr += 1
 
-    def generate(self):
-        lst = []
-        while True:
-            s = self.parser.advance()
-            if isinstance(s, SIGFINISH):
-                break
-            if isinstance(s, L):
-                self.sym_table.add_entry(s.content, self.line_no)
+            tables = [self.sym_table._table] * len(bounds)
+            self.inst = array.array("I")
+            for words in pool.map(encode_chunk, paths, starts, ends, tables):
+                self.inst.extend(words)
+
+    def generate_incremental(self, cache_path):
+        # regions whose text hash is in the cache of the previous run keep
+        # their encoded words, only symbol references whose address moved
+        # are patched. changed regions are encoded from scratch.
+        cache = load_cache(cache_path) or {"vars": None, "symbols": {}, "regions": {}}
+        regions = split_regions(iter_instructions(self.input_file))
+        hashes = [hashlib.blake2b("\n".join(lines).encode(), digest_size=16).digest()
+                  for lines in regions]
+
+        entries = []
+        for lines, h in zip(regions, hashes):
+            entry = cache["regions"].get(h)
+            if entry is None:
+                entries.append((encode_region(lines), False))
             else:
-                lst.append(s)
+                labels, words, refs = entry
+                entries.append(((labels, array.array("I", words), refs), True))
+
+        for (labels, words, refs), _ in entries:
+            for label, offset in labels:
+                self.sym_table.add_entry(label, self.line_no + offset)
+            self.line_no += len(words)
+
+        variables = []
+        for (labels, words, refs), _ in entries:
+            for offset, symbol in refs:
+                if not self.sym_table.contains(symbol):
+                    self.sym_table.add_entry(symbol, self.var_addr)
+                    self.var_addr += 1
+                    variables.append(symbol)
+
+        if variables != cache["vars"]:
+            # variable addresses are baked into the cached words
+            entries = [(encode_region(lines), False) for lines in regions]
+
+        old = cache["symbols"]
+        table = self.sym_table._table
+        self.inst = array.array("I")
+        new_regions = {}
+        reused = 0
+        for ((labels, words, refs), cached), h in zip(entries, hashes):
+            for offset, symbol in refs:
+                if not cached or old.get(symbol) != table[symbol]:
+                    words[offset] = check_address(symbol, table[symbol])
+            reused += cached
+            new_regions[h] = (labels, words, refs)
+            self.inst.extend(words)
+        print(f"reused {reused}/{len(regions)} regions")
+
+        with open(cache_path, "wb") as f:
+            pickle.dump({"version": CACHE_VERSION,
+                         "vars": variables,
+                         "symbols": dict(table),
+                         "regions": new_regions}, f, pickle.HIGHEST_PROTOCOL)
+
+    def save(self, write_path, fmt="hack"):
+        save(self.inst, write_path, fmt)
+
+    def stream(self, write_path, fmt="hack"):
+        # single pass: every word is written as soon as it is parsed. symbols
+        # that are not known yet get a placeholder and are backpatched at the
+        # end, so only the labels and the pending references are kept.
+        encode = output_formats[fmt][1]
+        record = len(encode(0))
+        pending = {}
+        with open(write_path, "wb") as g:
+            while True:
+                s = self.parser.advance()
+                if isinstance(s, SIGFINISH):
+                    break
+                if isinstance(s, L):
+                    self.sym_table.add_entry(s.content, self.line_no)
+                    continue
+                if isinstance(s, A) and s.is_symbol:
+                    if self.sym_table.contains(s.content):
+                        s.set_value(check_address(s.content, self.sym_table.get_address(s.content)))
+                    else:
+                        pending.setdefault(s.content, []).append(self.line_no)
+                        s.set_value(0)
+                g.write(encode(s.to_int()))
                 self.line_no += 1
 
-        for parsed in lst:
-            if isinstance(parsed, L):
-                raise Exception
-            elif isinstance(parsed, A):
-                if parsed.is_symbol:
-                    if not self.sym_table.contains(parsed.content):
-                        self.sym_table.add_entry(parsed.content, self.var_addr)
-                        self.var_addr += 1
-                    parsed.set_value(self.sym_table.get_address(parsed.content))
-                self.inst.append(parsed.to_bin())
-            elif isinstance(parsed, C):
-                self.inst.append(parsed.to_bin())
-            else:
-                raise Exception()
-
-    def save(self, write_path):
-        with open(write_path + "", "w") as g:
-            for i in self.inst:
-                g.write(i + "\n")
+            # pending keeps the order of first use, which is the order the
+            # two-pass path allocates variables in.
+            for symbol, positions in pending.items():
+                if not self.sym_table.contains(symbol):
+                    self.sym_table.add_entry(symbol, self.var_addr)
+                    self.var_addr += 1
+                word = encode(check_address(symbol, self.sym_table.get_address(symbol)))
+                for pos in positions:
+                    g.seek(pos * record)
+                    g.write(word)
 
 
 if __name__ == "__main__":
     arg_parser = argparse.ArgumentParser(description="Process some integers.")
-    arg_parser.add_argument("asm", help=".asm file")
+    arg_parser.add_argument("asm", nargs="+", help=".asm file, or .asm/.hobj files with -c/--link")
+    arg_parser.add_argument("--stream", action="store_true",
+                            help="single pass, backpatch forward references in the output file")
+    arg_parser.add_argument("-j", "--jobs", type=int, default=1,
+                            help="assemble in chunks (or modules with -c) with this many processes")
+    arg_parser.add_argument("--incremental", action="store_true",
+                            help="reuse unchanged regions from the cache of the previous run")
+    arg_parser.add_argument("-O", dest="optimize", action="count", default=0,
+                            help="-O: peephole, -OO: also jump threading and dead code")
+    arg_parser.add_argument("-c", dest="compile", action="store_true",
+                            help="write a relocatable .hobj for every .asm")
+    arg_parser.add_argument("--link", action="store_true",
+                            help="link .hobj files into one program")
+    arg_parser.add_argument("-o", dest="output", help="output path for --link")
+    arg_parser.add_argument("--format", choices=output_formats, default="hack",
+                            help="hack: one line of 16 bits per word, bin: packed little-endian uint16")
     args = arg_parser.parse_args()
-    read_path = args.asm
-    # read_path = "./rect/Rect.asm"
-    write_path = read_path.replace(".asm", ".hack")
 
-    assembler = Assembler(read_path)
-    assembler.generate()
-    assembler.save(write_path)
+    if args.compile:
+        with concurrent.futures.ProcessPoolExecutor(args.jobs) as pool:
+            for path, counts in pool.map(compile_file, args.asm, [args.optimize] * len(args.asm)):
+                if counts:
+                    print(f"{path}: {optimize_report(counts)}")
+                print("output:", path)
+        sys.exit()
+    if args.link:
+        write_path = args.output or args.asm[0].replace(".hobj", output_formats[args.format][0])
+        save(link([read_object(path) for path in args.asm]), write_path, args.format)
+        sys.exit()
+    if len(args.asm) > 1:
+        arg_parser.error("more than one input needs -c or --link")
+
+    read_path = args.asm[0]
+    # read_path = "./rect/Rect.asm"
+    write_path = read_path.replace(".asm", output_formats[args.format][0])
+
+    if args.optimize and (args.stream or args.incremental or args.jobs > 1):
+        arg_parser.error("-O only works with the default two-pass mode")
+
+    if args.stream:
+        assembler = Assembler(read_path)
+        assembler.stream(write_path, args.format)
+    elif args.incremental:
+        assembler = Assembler(read_path)
+        assembler.generate_incremental(read_path + ".cache")
+        assembler.save(write_path, args.format)
+    elif args.jobs > 1:
+        assembler = Assembler(read_path)
+        assembler.generate_parallel(args.jobs)
+        assembler.save(write_path, args.format)
+    else:
+        counts = {}
+        save(assemble(iter_instructions(read_path), args.optimize, counts=counts), write_path, args.format)
+        if counts:
+            print(optimize_report(counts))
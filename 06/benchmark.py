@@ -0,0 +1,150 @@
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import pathlib
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+
+import assembler
+
+FIXTURES = [pathlib.Path(__file__).parent.parent / "04" / name for name in ("Mult.asm", "Fill.asm")]
+
+GEN_COMPS = ["D", "M", "A", "D+1", "M+1", "M-1", "D-1", "D+M", "D-M", "M-D", "D&M", "D|M", "!D", "-1", "0"]
+GEN_DESTS = ["D", "M", "MD", "A", "AM"]
+GEN_JUMPS = ["JGT", "JEQ", "JGE", "JLT", "JNE", "JLE"]
+
+
+def generate(path, n_inst, label_density=0.02, n_vars=100, comment_density=0.1, seed=0):
+    # synthetic program of n_inst instructions. every jump goes to a label
+    # that is defined somewhere in the file.
+    rng = random.Random(seed)
+    n_labels = int(n_inst * label_density)
+    label_at = set(rng.sample(range(n_inst), min(n_labels, n_inst)))
+    # the label at instruction i is at ROM address i, and labels are numbered
+    # in address order, so the ones inside the 32K ROM are the first
+    # n_targets. only those can be jumped to, the rest are just defined.
+    n_targets = sum(1 for i in label_at if i < 32768)
+    lines = 0
+    with open(path, "w") as f:
+        label = 0
+        i = 0
+        while i < n_inst:
+            if rng.random() < comment_density:
+                f.write(f"// comment {i}\n")
+                lines += 1
+            if i in label_at:
+                f.write(f"(L{label})\n")
+                label += 1
+                lines += 1
+            r = rng.random()
+            # a jump is two instructions, so it must not step over a label
+            if r < 0.15 and n_targets and i + 1 < n_inst and i + 1 not in label_at:
+                f.write(f"@L{rng.randrange(n_targets)}\n")
+                f.write(rng.choice(["0;JMP", "D;" + rng.choice(GEN_JUMPS)]) + "\n")
+                lines += 2
+                i += 2
+                continue
+            if r < 0.35:
+                f.write(f"@v{rng.randrange(n_vars)}\n" if n_vars else "@SP\n")
+            elif r < 0.5:
+                f.write(f"@{rng.randrange(32768)}\n")
+            else:
+                f.write(f"{rng.choice(GEN_DESTS)}={rng.choice(GEN_COMPS)}\n")
+            lines += 1
+            i += 1
+    return lines
+
+
+def run_case(path, optimize=0):
+    # one assembly of path through assembler.assemble, split into its passes
+    passes = {}
+    last = [time.perf_counter()]
+
+    def on_pass(name):
+        now = time.perf_counter()
+        passes[name] = now - last[0]
+        last[0] = now
+
+    words = assembler.assemble(assembler.iter_instructions(path), optimize, on_pass)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        t = time.perf_counter()
+        assembler.save(words, os.path.join(tmp, "out.hack"))
+        passes["write"] = time.perf_counter() - t
+    return {"words": len(words),
+            "passes": passes,
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def measure(name, path, lines, optimize=0):
+    # every case runs in a fresh process so the peak RSS is its own
+    ctx = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=ctx) as pool:
+        result = pool.submit(run_case, str(path), optimize).result()
+    seconds = sum(result["passes"].values())
+    result.update({"name": name,
+                   "lines": lines,
+                   "seconds": seconds,
+                   "lines_per_sec": lines / seconds if seconds else 0.0})
+    return result
+
+
+def report(result, baseline=None):
+    line = (f"{result['name']:>24} {result['lines']:>9} lines {result['seconds']:8.3f}s "
+            f"{result['lines_per_sec']:>12,.0f} lines/s {result['peak_rss_kb'] // 1024:>6} MB")
+    if baseline and result["name"] in baseline:
+        line += f"  x{baseline[result['name']]['seconds'] / result['seconds']:.2f} vs baseline"
+    print(line)
+    print(" " * 25 + "  ".join(f"{k} {v:.3f}" for k, v in result["passes"].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000],
+                        help="instructions per synthetic program (10K to 5M)")
+    parser.add_argument("--labels", type=float, default=0.02, help="labels per instruction")
+    parser.add_argument("--vars", type=int, default=100, help="number of distinct variables")
+    parser.add_argument("--comments", type=float, default=0.1, help="comment lines per instruction")
+    parser.add_argument("-O", dest="optimize", type=int, nargs="?", const=1, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="bench_results.json", help="where to save the results")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {r["name"]: r for r in json.load(f)["results"]}
+
+    results = []
+    for path in FIXTURES:
+        with open(path) as f:
+            lines = sum(1 for _ in f)
+        results.append(measure(path.name, path, lines, args.optimize))
+        report(results[-1], baseline)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            path = os.path.join(tmp, f"synthetic_{size}.asm")
+            lines = generate(path, size, args.labels, args.vars, args.comments, args.seed)
+            results.append(measure(f"synthetic_{size}", path, lines, args.optimize))
+            report(results[-1], baseline)
+            os.remove(path)
+
+    with open(args.out, "w") as f:
+        json.dump({"python": sys.version,
+                   "platform": platform.platform(),
+                   "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   "params": vars(args),
+                   "results": results}, f, indent=2)
+    print("output:", args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,17 @@
 import argparse
+import array
+import collections
+import concurrent.futures
 import enum
+import hashlib
+import io
+import itertools
 import os
 import pathlib
+import pickle
 from typing import TextIO
 
 
-class CONST(enum.Enum):
-    EOF = 0
-
-
 class Ctypes(enum.Enum):
     C_ARITHMETIC = enum.auto()
     C_PUSH = enum.auto()
@@ -19,6 +22,9 @@ class Ctypes(enum.Enum):
     C_FUNCTION = enum.auto()
     C_RETURN = enum.auto()
     C_CALL = enum.auto()
+    # only made by inline_functions()
+    C_INLINE_ENTER = enum.auto()
+    C_INLINE_RETURN = enum.auto()
 
 
 map_ctypes = {
@@ -36,24 +42,31 @@ map_ctypes = {
 class VMParser:
     def __init__(self, f: TextIO):
         self.f = f
-        self.vm_comm = next(self.f, CONST.EOF)
-        self._next_line = None
+        # the first line of a .vm file is never read as a command
+        next(self.f, None)
+        self._parsed = {}
         self._comm_type = None
         self._arg1 = None
         self._arg2 = None
 
-    def has_more_lines(self):
-        self._next_line = next(self.f, CONST.EOF)
-        return self._next_line != CONST.EOF
-
-    def advance(self):
-        self.vm_comm = self._next_line
+    def commands(self):
+        # (command type, arg1, arg2) for every command in the file. repeated
+        # lines are parsed once.
+        for line in self.f:
+            command = self._parsed.get(line)
+            if command is None:
+                vm_comm = self.strip_comment(line)
+                command = self.parse(vm_comm) if vm_comm else ()
+                self._parsed[line] = command
+            if command:
+                yield command
 
-    def strip_comment(self):
-        self.vm_comm = self.vm_comm[:self.vm_comm.find("//")].strip()
+    @staticmethod
+    def strip_comment(line):
+        return line.split("//", 1)[0].strip()
 
-    def parse(self):
-        lst = self.vm_comm.strip().split()
+    def parse(self, vm_comm):
+        lst = vm_comm.split()
         _c_type = lst[0].strip()
         self._arg1 = None
         self._arg2 = None
@@ -69,6 +82,7 @@ class VMParser:
             self._comm_type = get_or_raise(_c_type, map_ctypes)
             self._arg1 = lst[1].strip()
             self._arg2 = int(lst[2].strip())
+        return self._comm_type, self._arg1, self._arg2
 
     @property
     def command_type(self) -> Ctypes:
@@ -111,14 +125,51 @@ map_cmp_op = {
     "lt": "JLT"
 }
 
+map_cmp_neg_op = {
+    "eq": "JNE",
+    "gt": "JLE",
+    "lt": "JGE"
+}
+
+# constant folding, on 16 bit words. comparisons look at the sign of the
+# wrapped x - y like the generated code does
+map_fold_op = {
+    "add": lambda x, y: x + y,
+    "sub": lambda x, y: x - y,
+    "and": lambda x, y: x & y,
+    "or": lambda x, y: x | y,
+    "eq": lambda x, y: -(to_signed(x - y) == 0),
+    "gt": lambda x, y: -(to_signed(x - y) > 0),
+    "lt": lambda x, y: -(to_signed(x - y) < 0),
+    "neg": lambda x: -x,
+    "not": lambda x: ~x,
+}
+
+# x op c == x
+map_fold_identity = {
+    "add": 0,
+    "sub": 0,
+    "or": 0,
+    "and": 0xFFFF
+}
+
 map_mem_seg = {
     "local": "LCL",
     "argument": "ARG",
     "this": "THIS",
-    "that": "THAT"
+    "that": "THAT",
+    "inline": "R14"  # arguments then locals of an inlined function
 }
 
 STACK_BASE_ADDR = 256
+MAX_INC_ADDR = 4  # segment offsets up to this are reached with A=A+1
+SHARED_CALL = "$$CALL"
+SHARED_RETURN = "$$RETURN"
+SHARED_HALT = "$$HALT"
+SHARED_TAIL = "$$TAIL"
+INLINE_BASE = "R14"  # only call/return and the tail routine use it, inlined bodies have neither
+CACHE_VERSION = 3
+WRITE_BUFFER_LINES = 1 << 16  # CodeWriter output is written out in chunks of this many lines
 ASM_STACK_PUSH = ["@SP",
                   "AM=M+1",
                   "A=A-1",
@@ -138,6 +189,11 @@ ASM_STACK_POP = ["@SP",
                  "D=M"]
 
 
+def to_signed(v):
+    v &= 0xFFFF
+    return v - 0x10000 if v & 0x8000 else v
+
+
 def get_or_raise(key, map):
     v = map.get(key, None)
     if v is None:
@@ -146,29 +202,192 @@ def get_or_raise(key, map):
 
 
 def write_asm(f, lst):
+    if isinstance(f, RomWriter):
+        f.emit(lst)
+        return
     f.write("\n".join(lst) + "\n")
 
 
+# hack encoding, for writing .hack without going through 06/assembler.py
+map_rom_comp_bits = {"0": 0b101010, "1": 0b111111, "-1": 0b111010, "D": 0b001100, "A": 0b110000,
+                     "!D": 0b001101, "!A": 0b110001, "-D": 0b001111, "-A": 0b110011,
+                     "D+1": 0b011111, "A+1": 0b110111, "D-1": 0b001110, "A-1": 0b110010,
+                     "D+A": 0b000010, "A+D": 0b000010, "D-A": 0b010011, "A-D": 0b000111,
+                     "D&A": 0b000000, "A&D": 0b000000, "D|A": 0b010101, "A|D": 0b010101}
+map_rom_jump_bits = {"JGT": 1, "JEQ": 2, "JGE": 3, "JLT": 4, "JNE": 5, "JLE": 6, "JMP": 7}
+map_rom_predefined = {"SP": 0, "LCL": 1, "ARG": 2, "THIS": 3, "THAT": 4, "SCREEN": 16384, "KBD": 24576}
+map_rom_predefined.update({f"R{i}": i for i in range(16)})
+
+
+def _build_rom_c_table():
+    # every "dest=comp;jump" spelling the CodeWriter can produce -> its word
+    comps = {}
+    for comp, c in map_rom_comp_bits.items():
+        comps[comp] = c
+        if "A" in comp:
+            comps[comp.replace("A", "M")] = 0b1000000 | c
+    dests = {"": 0}
+    for dest in itertools.chain.from_iterable(itertools.permutations("ADM", n) for n in (1, 2, 3)):
+        dests["".join(dest) + "="] = sum({"A": 4, "D": 2, "M": 1}[r] for r in dest)
+    jumps = {"": 0}
+    jumps.update({";" + jump: j for jump, j in map_rom_jump_bits.items()})
+    table = {}
+    for comp, c in comps.items():
+        for dest, d in dests.items():
+            for jump, j in jumps.items():
+                table[dest + comp + jump] = 0xE000 | c << 6 | d << 3 | j
+    return table
+
+
+map_rom_c_inst = _build_rom_c_table()
+
+
+class RomWriter:
+    # takes the CodeWriter output as instruction lists and encodes it into
+    # a ROM image as it goes. symbols are patched when the writer is closed:
+    # labels first, the rest are variables from 16 in order of first use,
+    # like 06/assembler.py.
+    def __init__(self, hack_path, dump: TextIO = None):
+        self.hack_path = hack_path
+        self.dump = dump  # optional .asm copy of the output
+        self.rom = array.array("H")
+        self.labels = {}
+        self.fixups = []  # (rom address, symbol)
+        self._words = dict(map_rom_c_inst)  # instruction -> word, A-constants are added as they come
+
+    def write(self, text):
+        # asm text, e.g. from the -j workers or the cache
+        self.emit(text.splitlines())
+
+    def emit(self, lst):
+        if self.dump:
+            self.dump.write("\n".join(lst) + "\n")
+        for inst in lst:
+            word = self._words.get(inst)
+            if word is None:
+                if inst[0] == "(":
+                    self.labels[inst[1:-1]] = len(self.rom)
+                    continue
+                if inst[0] == "@":
+                    sym = inst[1:]
+                    if sym.isdigit():
+                        word = int(sym)
+                    elif sym in map_rom_predefined:
+                        word = map_rom_predefined[sym]
+                    else:
+                        self.fixups.append((len(self.rom), sym))
+                        self.rom.append(0)
+                        continue
+                else:
+                    raise Exception(f"can not encode {inst}")
+                self._words[inst] = word
+            self.rom.append(word)
+
+    def link(self):
+        if len(self.rom) > 32768:
+            raise Exception(f"program does not fit in ROM: {len(self.rom)} words")
+        variables = {}
+        for addr, sym in self.fixups:
+            value = self.labels.get(sym)
+            if value is None:
+                value = variables.setdefault(sym, 16 + len(variables))
+            if value > 32767:
+                raise Exception(f"program does not fit in ROM: {sym} is at {value}")
+            self.rom[addr] = value
+        return self.rom
+
+    def close(self):
+        rom = self.link()
+        with open(self.hack_path, "w") as f:
+            f.write("".join(f"{word:016b}\n" for word in rom))
+        if self.dump:
+            self.dump.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.dump:
+            self.dump.close()
+
+
+def count_words(lst):
+    return sum(1 for line in lst if not line.startswith("("))
+
+
 class CodeWriter:
-    def __init__(self, f):
+    def __init__(self, f, shared_frames=False, shared_cmp=False, tos=False, scoped=False, tail_calls=False):
         self.f = f
         self._jmp_cnt = 0
+        self.scoped = scoped  # label counters restart per file, under the file name
+        self._scope = ""
         self.file_name = None
         self.func_name = "SYSTEM"
+        self.shared_frames = shared_frames
+        self.tail_calls = tail_calls
+        # with the top of stack in D an inline compare is smaller than a
+        # shared site plus the spill and reload around it
+        self.shared_cmp = shared_cmp and not tos
+        self.hot = False  # set by translate() for commands inside a loop
+        self.stats = collections.Counter()
+        self.tos = tos
+        self._cached = False  # top of stack is in D, not in RAM
+        self._out = []  # lines not yet written to f
+        self._templates = {}  # push/pop/op instructions by (command, segment, index)
+
+    def _write(self, lst):
+        self._out.extend(lst)
+        if len(self._out) >= WRITE_BUFFER_LINES:
+            self.flush()
+
+    def flush(self):
+        if self._out:
+            write_asm(self.f, self._out)
+            self._out = []
+
+    def _template(self, key, build):
+        t = self._templates.get(key)
+        if t is None:
+            t = self._templates[key] = tuple(build())
+        return t
+
+    def _spill(self):
+        # stores a top of stack held in D, before anything that expects
+        # the whole stack in RAM
+        if not self._cached:
+            return []
+        self._cached = False
+        return list(ASM_STACK_PUSH)
 
     def set_filename(self, file_name):
+        self._write(self._spill())
         self.file_name = file_name
+        self._templates.clear()  # static names depend on the file
+        if self.scoped:
+            self._scope = f"{file_name}."
+            self._jmp_cnt = 0
 
     def bootstrap(self):
         s = [f"@{STACK_BASE_ADDR}",
              "D=A",
              "@SP",
              "M=D"]
-        write_asm(self.f, s)
+        self._write(s)
         self.write_call("Sys.init", 0)
 
     def write_call(self, func_name, n_args):
-        return_addr = f"{func_name}$ret.{self._jmp_cnt}"
+        return_addr = f"{func_name}$ret.{self._scope}{self._jmp_cnt}"
+        if self.shared_frames:
+            s = self._call_site(func_name, n_args, return_addr)
+            self.stats["call"] += 1
+        else:
+            s = self._call_inline(func_name, n_args, return_addr)
+        self._write(self._spill() + s)
+        self._jmp_cnt += 1
+
+    def _call_inline(self, func_name, n_args, return_addr):
         s = [f"@{return_addr}", "D=A"] + ASM_STACK_PUSH  # push returnAddress
         s += ["@LCL", "D=M"] + ASM_STACK_PUSH  # push LCL
         s += ["@ARG", "D=M"] + ASM_STACK_PUSH  # push ARG
@@ -178,8 +397,86 @@ class CodeWriter:
         s += ["@5", "D=D-A", f"@{n_args}", "D=D-A", "@ARG", "M=D"]  # ARG = SP - 5 - nArgs
         s += [f"@{func_name}", "0;JMP"]  # goto f
         s += [f"({return_addr})"]  # (returnAddress)
-        write_asm(self.f, s)
-        self._jmp_cnt += 1
+        return s
+
+    def _call_site(self, func_name, n_args, return_addr):
+        # R14 = returnAddress, R13 = f, D = nArgs, then the shared routine
+        return [f"@{return_addr}", "D=A", "@R14", "M=D",
+                f"@{func_name}", "D=A", "@R13", "M=D",
+                f"@{n_args}", "D=A",
+                f"@{SHARED_CALL}", "0;JMP",
+                f"({return_addr})"]
+
+    def _shared_call(self):
+        s = [f"({SHARED_CALL})", "@R15", "M=D"]  # nArgs
+        s += ["@R14", "D=M"] + ASM_STACK_PUSH  # push returnAddress
+        s += ["@LCL", "D=M"] + ASM_STACK_PUSH  # push LCL
+        s += ["@ARG", "D=M"] + ASM_STACK_PUSH  # push ARG
+        s += ["@THIS", "D=M"] + ASM_STACK_PUSH  # push THIS
+        s += ["@THAT", "D=M"] + ASM_STACK_PUSH  # push THAT
+        s += ["@SP", "D=M", "@LCL", "M=D"]  # LCL = SP
+        s += ["@R15", "D=D-M", "@5", "D=D-A", "@ARG", "M=D"]  # ARG = SP - nArgs - 5
+        s += ["@R13", "A=M", "0;JMP"]  # goto f
+        return s
+
+    def finish(self):
+        # shared routines go after the program, behind a halt loop in case
+        # execution falls off its end
+        self._write(self._spill())
+        s = []
+        if self.stats["call"] or self.stats["return"]:
+            s += self._shared_call() + [f"({SHARED_RETURN})"] + self._return_inline()
+        for comm in map_cmp_op:
+            if self.stats[f"{comm} shared"]:
+                s += self._shared_cmp(comm)
+        if self.stats["tail call"]:
+            s += self._shared_tail()
+        if s:
+            self._write([f"({SHARED_HALT})", f"@{SHARED_HALT}", "0;JMP"] + s)
+        self.flush()
+
+    def report(self):
+        lines = []
+        if self.shared_frames:
+            calls, returns = self.stats["call"], self.stats["return"]
+            call_inline = count_words(self._call_inline("f", 0, "r"))
+            call_site = count_words(self._call_site("f", 0, "r"))
+            call_shared = count_words(self._shared_call())
+            return_inline = count_words(self._return_inline())
+            routines = 2 + call_shared + return_inline if calls or returns else 0
+            saved = calls * (call_inline - call_site) + returns * (return_inline - 2) - routines
+            lines.append(f"shared frames: {calls} calls ({call_inline} -> {call_site} words), "
+                         f"{returns} returns ({return_inline} -> 2 words), {routines} words of routines"
+                         + (f", plus {self.stats['tail call']} tail calls"
+                            if self.stats["tail call"] else ""))
+            lines.append(f"shared frames: {saved} ROM words saved, "
+                         f"+{call_site + call_shared - call_inline} cycles per call, +2 per return")
+        if self.shared_cmp:
+            inline = count_words(self._cmp_inline("eq", "0"))
+            site = count_words(self._cmp_site("eq", "0"))
+            shared = sum(self.stats[f"{comm} shared"] for comm in map_cmp_op)
+            routines = sum(count_words(self._shared_cmp(comm))
+                           for comm in map_cmp_op if self.stats[f"{comm} shared"])
+            lines.append(f"shared comparisons: {self.stats['cmp inline']} inline in loops, "
+                         f"{shared} shared ({inline} -> {site} words), {routines} words of routines, "
+                         f"{shared * (inline - site) - routines} ROM words saved")
+        if self.stats["tail call"]:
+            # a tail call replaces the call and the return this writer would
+            # have emitted
+            calls = self.stats["tail call"]
+            site = count_words(self._tail_site("f", 0))
+            if self.shared_frames:
+                call_return = count_words(self._call_site("f", 0, "r")) + 2
+            else:
+                call_return = count_words(self._call_inline("f", 0, "r")) + count_words(self._return_inline())
+            routine = count_words(self._shared_tail())
+            lines.append(f"tail calls: {calls} ({call_return} -> {site} words), {routine} words of routine, "
+                         f"{calls * (call_return - site) - routine} ROM words saved")
+            lines.append("tail calls: trade cycles for stack, every one copies its arguments and the frame "
+                         "in the routine, but a chain of tail calls runs in one frame")
+        if self.stats["folded"]:
+            lines.append(f"constant folding: {self.stats['folded']} VM commands removed")
+        return lines
 
     def write_function(self, func_name, n_vars):
         self.func_name = func_name
@@ -194,9 +491,17 @@ class CodeWriter:
                   "M=0",
                   f"@{func_name}_rep",
                   "D=D-1;JGT"]
-        write_asm(self.f, s)
+        self._write(self._spill() + s)
 
     def write_return(self):
+        if self.shared_frames:
+            s = [f"@{SHARED_RETURN}", "0;JMP"]
+            self.stats["return"] += 1
+        else:
+            s = self._return_inline()
+        self._write(self._spill() + s)
+
+    def _return_inline(self):
         # frame = "R13", ret_addr = "R14"
         s = ["@LCL", "D=M", "@R13", "M=D",  # frame = LCL
              "@5", "A=D-A", "D=M", "@R14", "M=D",  # retAddr = *(frame - 5)
@@ -207,51 +512,67 @@ class CodeWriter:
              "@R13", "AM=M-1", "D=M", "@ARG", "M=D",  # ARG = *(frame - 3)
              "@R13", "AM=M-1", "D=M", "@LCL", "M=D",  # LCL = *(frame - 4)
              "@R14", "A=M", "0;JMP"]
-        write_asm(self.f, s)
+        return s
 
     def write_arithmetic(self, comm: str):
+        if self.tos:
+            return self._write_arithmetic_tos(comm)
+        if comm in map_bi_op or comm in map_si_op:
+            s = self._template(comm, lambda: self._op(comm))
+        elif comm in map_cmp_op:
+            if self.shared_cmp and not self.hot:
+                s = self._cmp_site(comm, self._next_label())
+                self.stats[f"{comm} shared"] += 1
+            else:
+                s = self._cmp_inline(comm, self._next_label())
+                self.stats["cmp inline"] += 1
+        else:
+            raise NotImplementedError(comm)
+        self._write(s)
+
+    def _op(self, comm: str):
         if comm in map_bi_op:
             op = get_or_raise(comm, map_bi_op)
-            s = ["@SP",
-                 "AM=M-1",
-                 "D=M",
-                 "A=A-1",
-                 f"MD=M{op}D"]
+            return ["@SP",
+                    "AM=M-1",
+                    "D=M",
+                    "A=A-1",
+                    f"MD=M{op}D"]
+        op = get_or_raise(comm, map_si_op)
+        return ["@SP",
+                "AM=M-1",
+                f"MD={op}M",
+                "@SP",
+                "M=M+1"]
+
+    def _write_arithmetic_tos(self, comm: str):
+        # the result stays in D
+        if not self._cached:
+            self._write(ASM_STACK_POP)
+        if comm in map_bi_op:
+            s = self._template(comm, lambda: ["@SP", "AM=M-1", f"D=M{map_bi_op[comm]}D"])
         elif comm in map_si_op:
-            op = get_or_raise(comm, map_si_op)
-            s = ["@SP",
-                 "AM=M-1",
-                 f"MD={op}M",
-                 "@SP",
-                 "M=M+1"]
+            s = self._template(comm, lambda: [f"D={map_si_op[comm]}D"])
         elif comm in map_cmp_op:
-            op = get_or_raise(comm, map_cmp_op)
-            s = ["@R15",
-                 "M=-1",
-                 "@SP",
-                 "AM=M-1",
-                 "D=M",
-                 "@SP",
+            s = ["@SP",
                  "AM=M-1",
                  "D=M-D",
-                 f"@JMP_FALSE{self._jmp_cnt}",
-                 f"D;{op}",
-                 "@R15",
-                 "M=0",
-                 f"(JMP_FALSE{self._jmp_cnt})",
-                 "@R15",
-                 "D=M",
-                 "@SP",
-                 "A=M",
-                 "M=D",
-                 "@SP",
-                 "M=M+1"]
+                 f"@TOS_TRUE{self._scope}{self._jmp_cnt}",
+                 f"D;{map_cmp_op[comm]}",
+                 "D=0",
+                 f"@TOS_END{self._scope}{self._jmp_cnt}",
+                 "0;JMP",
+                 f"(TOS_TRUE{self._scope}{self._jmp_cnt})",
+                 "D=-1",
+                 f"(TOS_END{self._scope}{self._jmp_cnt})"]
             self._jmp_cnt += 1
+            self.stats["cmp inline"] += 1
         else:
             raise NotImplementedError(comm)
-        write_asm(self.f, s)
+        self._cached = True
+        self._write(s)
 
-    def write_push(self, seg: str, idx: int):
+    def _load_d(self, seg: str, idx: int):
         if seg == "constant":
             s = [f"@{idx}", "D=A"]
         elif seg == "pointer":
@@ -272,10 +593,9 @@ class CodeWriter:
                  f"@{idx}",
                  "A=D+A",
                  "D=M"]
-        s += ASM_STACK_PUSH
-        write_asm(self.f, s)
+        return s
 
-    def write_pop(self, seg: str, idx: int):
+    def _addr_d(self, seg: str, idx: int):
         if seg == "pointer":
             if idx == 0:
                 s = ["@THIS", "D=A"]
@@ -293,25 +613,570 @@ class CodeWriter:
                  "D=M",
                  f"@{idx}",
                  "D=D+A"]
-        s += ASM_STACK_POP_D
-        write_asm(self.f, s)
+        return s
+
+    def _store_d(self, seg: str, idx: int):
+        # stores D without going through R13, None if the address needs D
+        if seg == "pointer":
+            if idx == 0:
+                return ["@THIS", "M=D"]
+            elif idx == 1:
+                return ["@THAT", "M=D"]
+            else:
+                raise NotImplementedError(f"{seg} {idx}")
+        elif seg == "temp":
+            return [f"@{5 + idx}", "M=D"]
+        elif seg == "static":
+            return [f"@{self.file_name}.{idx}", "M=D"]
+        mem_seg = get_or_raise(seg, map_mem_seg)
+        if idx > MAX_INC_ADDR:
+            return None
+        return [f"@{mem_seg}", "A=M"] + ["A=A+1"] * idx + ["M=D"]
+
+    def _write_fused(self, seg: str, idx: int, s: list):
+        # s leaves the value to pop in D
+        store = self._store_d(seg, idx)
+        if store is None:
+            s = self._addr_d(seg, idx) + ["@R13", "M=D"] + s + ["@R13", "A=M", "M=D"]
+        else:
+            s = s + store
+        self._write(self._spill() + s)
+
+    def _next_label(self):
+        n = f"{self._scope}{self._jmp_cnt}"
+        self._jmp_cnt += 1
+        return n
+
+    def _cmp_inline(self, comm: str, n: str):
+        op = get_or_raise(comm, map_cmp_op)
+        s = ["@R15",
+             "M=-1",
+             "@SP",
+             "AM=M-1",
+             "D=M",
+             "@SP",
+             "AM=M-1",
+             "D=M-D",
+             f"@JMP_FALSE{n}",
+             f"D;{op}",
+             "@R15",
+             "M=0",
+             f"(JMP_FALSE{n})",
+             "@R15",
+             "D=M",
+             "@SP",
+             "A=M",
+             "M=D",
+             "@SP",
+             "M=M+1"]
+        return s
+
+    def _cmp_site(self, comm: str, n: str):
+        # D = return address, then the shared routine for comm
+        s = [f"@CMP_RET{n}",
+             "D=A",
+             f"@$${comm.upper()}",
+             "0;JMP",
+             f"(CMP_RET{n})"]
+        return s
+
+    def _shared_cmp(self, comm: str):
+        op = get_or_raise(comm, map_cmp_op)
+        name = f"$${comm.upper()}"
+        return [f"({name})",
+                "@R15",
+                "M=D",  # return address
+                "@SP",
+                "AM=M-1",
+                "D=M",
+                "A=A-1",
+                "D=M-D",
+                "M=-1",
+                f"@{name}_TRUE",
+                f"D;{op}",
+                "@SP",
+                "A=M-1",
+                "M=0",
+                f"({name}_TRUE)",
+                "@R15",
+                "A=M",
+                "0;JMP"]
+
+    def write_push(self, seg: str, idx: int):
+        if self.tos:
+            self._write(self._spill())
+            s = self._template(("push", seg, idx), lambda: self._load_d(seg, idx))
+            self._cached = True
+        else:
+            s = self._template(("push", seg, idx), lambda: self._load_d(seg, idx) + ASM_STACK_PUSH)
+        self._write(s)
+
+    def write_pop(self, seg: str, idx: int):
+        if self._cached:
+            s = self._template(("pop cached", seg, idx), lambda: self._pop_cached(seg, idx))
+            self._cached = False
+        else:
+            s = self._template(("pop", seg, idx), lambda: self._addr_d(seg, idx) + ASM_STACK_POP_D)
+        self._write(s)
+
+    def _pop_cached(self, seg: str, idx: int):
+        s = self._store_d(seg, idx)
+        if s is None:
+            # D = address + value, then A = D - value and D = D - A
+            s = ["@R13", "M=D"] + self._addr_d(seg, idx) + ["@R13", "D=D+M", "A=D-M", "D=D-A", "M=D"]
+        return s
+
+    def write_push_pop(self, seg1: str, idx1: int, seg2: str, idx2: int):
+        # push seg1 idx1; pop seg2 idx2 as a memory to memory move
+        self._write_fused(seg2, idx2, self._load_d(seg1, idx1))
+
+    def write_push_op_pop(self, seg1: str, idx1: int, comm: str, seg2: str, idx2: int):
+        # push seg1 idx1; comm; pop seg2 idx2 without pushing the operand
+        s = self._load_d(seg1, idx1)
+        if comm in map_bi_op:
+            s += ["@SP", "AM=M-1", f"D=M{map_bi_op[comm]}D"]
+        else:
+            s += [f"D={get_or_raise(comm, map_si_op)}D"]
+        self._write_fused(seg2, idx2, s)
+
+    def write_push_const_op(self, idx: int, comm: str):
+        # push constant idx; neg/not with the operator applied to A
+        s = [f"@{idx}", f"D={get_or_raise(comm, map_si_op)}A"]
+        if self.tos:
+            self._write(self._spill())
+            self._cached = True
+        else:
+            s += ASM_STACK_PUSH
+        self._write(s)
+
+    def write_tail_call(self, func_name, n_args):
+        # call f n; return, reusing the frame of the current function
+        self.stats["tail call"] += 1
+        self._write(self._spill() + self._tail_site(func_name, n_args))
+
+    def _tail_site(self, func_name, n_args):
+        # R13 = f, D = nArgs, then the shared routine
+        return [f"@{func_name}", "D=A", "@R13", "M=D",
+                f"@{n_args}", "D=A",
+                f"@{SHARED_TAIL}", "0;JMP"]
+
+    def _shared_tail(self):
+        # the n arguments on the stack go over ours and f returns straight to
+        # our caller. the saved frame is copied to the free stack above SP
+        # first, since the arguments may overlap it, and back above the new
+        # arguments. when we were called with n arguments too it is already
+        # in place.
+        s = [f"({SHARED_TAIL})", "@R14", "M=D"]  # R14 = n
+        s += ["@ARG", "D=M", "@R14", "D=D+M", "@R15", "M=D"]  # R15 = ARG + n
+        s += ["@LCL", "D=M", "@5", "D=D-A", "@R15", "D=D-M", f"@{SHARED_TAIL}_ARGS", "D;JEQ"]
+        for i in range(5):  # frame to SP..SP+4
+            s += ["@LCL", "D=M", f"@{5 - i}", "A=D-A", "D=M", "@SP", "A=M"] + ["A=A+1"] * i + ["M=D"]
+        s += [f"({SHARED_TAIL}_ARGS)", "@ARG", "D=M", "@R15", "M=D"]  # R15 = ARG
+        s += [f"({SHARED_TAIL}_LOOP)",  # arguments to ARG..ARG+n-1, lowest first
+              "@R14", "D=M", f"@{SHARED_TAIL}_FRAME", "D;JEQ",
+              "@SP", "D=M", "@R14", "A=D-M", "D=M",
+              "@R15", "AM=M+1", "A=A-1", "M=D",
+              "@R14", "M=M-1",
+              f"@{SHARED_TAIL}_LOOP", "0;JMP"]
+        s += [f"({SHARED_TAIL}_FRAME)",  # R15 = ARG + n
+              "@LCL", "D=M", "@5", "D=D-A", "@R15", "D=D-M", f"@{SHARED_TAIL}_COPY", "D;JNE",
+              "@5", "D=A", "@R15", "M=D+M", f"@{SHARED_TAIL}_SETUP", "0;JMP",
+              f"({SHARED_TAIL}_COPY)"]
+        for i in range(5):  # frame to ARG+n..ARG+n+4
+            s += ["@SP", "A=M"] + ["A=A+1"] * i + ["D=M", "@R15", "AM=M+1", "A=A-1", "M=D"]
+        s += [f"({SHARED_TAIL}_SETUP)",  # LCL = SP = ARG+n+5, goto f
+              "@R15", "D=M", "@SP", "M=D", "@LCL", "M=D",
+              "@R13", "A=M", "0;JMP"]
+        return s
+
+    def write_inline_enter(self, n_args: int):
+        # the inline segment starts at the first argument
+        s = ["@SP", "D=M", f"@{n_args}", "D=D-A", f"@{INLINE_BASE}", "M=D"]
+        self._write(self._spill() + s)
+
+    def write_inline_return(self):
+        # the return value goes where the first argument was, like return
+        s = [] if self._cached else list(ASM_STACK_POP)
+        s += [f"@{INLINE_BASE}", "A=M", "M=D", "D=A+1", "@SP", "M=D"]
+        self._cached = False
+        self._write(s)
 
     def write_label(self, label: str):
         s = [f"({self.func_name}${label})"]
-        write_asm(self.f, s)
+        self._write(self._spill() + s)
 
     def write_goto(self, label: str):
         s = [f"@{self.func_name}${label}", "0;JMP"]
-        write_asm(self.f, s)
+        self._write(self._spill() + s)
+
+    def write_cmp_if_goto(self, comm: str, negate: bool, label: str):
+        # comm [not] if-goto label, without materialising the boolean
+        op = get_or_raise(comm, map_cmp_neg_op if negate else map_cmp_op)
+        s = [] if self._cached else list(ASM_STACK_POP)
+        s += ["@SP", "AM=M-1", "D=M-D", f"@{self.func_name}${label}", f"D;{op}"]
+        self._cached = False
+        self._write(s)
 
     def write_if_goto(self, label: str):
-        s = ASM_STACK_POP + [f"@{self.func_name}${label}", "D;JNE"]
-        write_asm(self.f, s)
+        s = [] if self._cached else list(ASM_STACK_POP)
+        s += [f"@{self.func_name}${label}", "D;JNE"]
+        self._cached = False
+        self._write(s)
+
+
+def read_commands(path):
+    with open(path, 'r')as f:
+        return list(VMParser(f).commands())
+
+
+map_write_command = {
+    Ctypes.C_PUSH: CodeWriter.write_push,
+    Ctypes.C_POP: CodeWriter.write_pop,
+    Ctypes.C_ARITHMETIC: lambda code_writer, arg1, arg2: code_writer.write_arithmetic(arg1),
+    Ctypes.C_RETURN: lambda code_writer, arg1, arg2: code_writer.write_return(),
+    Ctypes.C_CALL: CodeWriter.write_call,
+    Ctypes.C_FUNCTION: CodeWriter.write_function,
+    Ctypes.C_GOTO: lambda code_writer, arg1, arg2: code_writer.write_goto(arg1),
+    Ctypes.C_IF: lambda code_writer, arg1, arg2: code_writer.write_if_goto(arg1),
+    Ctypes.C_LABEL: lambda code_writer, arg1, arg2: code_writer.write_label(arg1),
+    Ctypes.C_INLINE_ENTER: lambda code_writer, arg1, arg2: code_writer.write_inline_enter(arg2),
+    Ctypes.C_INLINE_RETURN: lambda code_writer, arg1, arg2: code_writer.write_inline_return(),
+}
+
+
+def const_at(commands, end):
+    # (value, number of commands) of a constant push ending at commands[end - 1].
+    # constants above 32767 are written as push constant ~k; not
+    if end >= 1 and commands[end - 1][0] == Ctypes.C_PUSH and commands[end - 1][1] == "constant":
+        return commands[end - 1][2] & 0xFFFF, 1
+    if end >= 2 and commands[end - 1][:2] == (Ctypes.C_ARITHMETIC, "not") \
+            and commands[end - 2][0] == Ctypes.C_PUSH and commands[end - 2][1] == "constant":
+        return ~commands[end - 2][2] & 0xFFFF, 2
+    return None, 0
+
+
+def push_const(value):
+    value &= 0xFFFF
+    if value < 0x8000:
+        return [(Ctypes.C_PUSH, "constant", value)]
+    return [(Ctypes.C_PUSH, "constant", ~value & 0xFFFF), (Ctypes.C_ARITHMETIC, "not", None)]
+
+
+def fold_constants(commands):
+    # evaluates arithmetic on constants, drops x + 0, x - 0, x | 0, x & -1
+    # and not not / neg neg, and turns if-goto on a constant into goto or
+    # nothing. works on the output so far, so nothing folds across a label.
+    out = []
+    for command in commands:
+        c_type, arg1, _ = command
+        if c_type == Ctypes.C_ARITHMETIC:
+            y, ny = const_at(out, len(out))
+            if arg1 in map_si_op:
+                if ny:
+                    del out[-ny:]
+                    out += push_const(map_fold_op[arg1](y))
+                    continue
+                if out and out[-1] == command:
+                    out.pop()
+                    continue
+            else:
+                x, nx = const_at(out, len(out) - ny) if ny else (None, 0)
+                if nx:
+                    del out[-nx - ny:]
+                    out += push_const(map_fold_op[arg1](x, y))
+                    continue
+                if ny and map_fold_identity.get(arg1) == y:
+                    del out[-ny:]
+                    continue
+                if not ny and out and out[-1][0] == Ctypes.C_PUSH and arg1 != "sub":
+                    # c op (push x), when op is commutative
+                    x, nx = const_at(out, len(out) - 1)
+                    if nx and map_fold_identity.get(arg1) == x:
+                        del out[-nx - 1:-1]
+                        continue
+        elif c_type == Ctypes.C_IF:
+            y, ny = const_at(out, len(out))
+            if ny:
+                del out[-ny:]
+                if y:
+                    out.append((Ctypes.C_GOTO, arg1, None))
+                continue
+        out.append(command)
+    return out
+
+
+def loop_mask(commands):
+    # marks the commands between a label and a later jump back to it
+    mask = bytearray(len(commands))
+    labels = {}
+    for i, (c_type, arg1, arg2) in enumerate(commands):
+        if c_type == Ctypes.C_FUNCTION:
+            labels = {}
+        elif c_type == Ctypes.C_LABEL:
+            labels[arg1] = i
+        elif c_type in (Ctypes.C_GOTO, Ctypes.C_IF) and arg1 in labels:
+            mask[labels[arg1]:i + 1] = b"\x01" * (i + 1 - labels[arg1])
+    return mask
+
+
+def prune_functions(files, entry="Sys.init"):
+    # keeps only the functions reachable by calls from entry. files is a
+    # list of (file name, commands); returns the pruned list and the names
+    # of the dropped functions
+    bodies = {}
+    calls = {}
+    for _, commands in files:
+        func_name = None
+        for c_type, arg1, arg2 in commands:
+            if c_type == Ctypes.C_FUNCTION:
+                func_name = arg1
+                bodies[func_name] = True
+                calls[func_name] = set()
+            elif c_type == Ctypes.C_CALL and func_name is not None:
+                calls[func_name].add(arg1)
+    if entry not in bodies:
+        raise Exception(f"entry function {entry} is not defined")
+
+    reachable = {entry}
+    todo = [entry]
+    while todo:
+        for callee in calls[todo.pop()]:
+            if callee not in reachable and callee in bodies:
+                reachable.add(callee)
+                todo.append(callee)
+
+    pruned = []
+    dropped = []
+    for fname, commands in files:
+        keep = []
+        live = True  # commands before the first function are always kept
+        for command in commands:
+            if command[0] == Ctypes.C_FUNCTION:
+                live = command[1] in reachable
+                if not live:
+                    dropped.append(command[1])
+            if live:
+                keep.append(command)
+        pruned.append((fname, keep))
+    return pruned, dropped
+
+
+def function_bodies(files):
+    # function name -> (file name, n_vars, commands after the function command)
+    bodies = {}
+    for fname, commands in files:
+        body = None
+        for command in commands:
+            if command[0] == Ctypes.C_FUNCTION:
+                body = []
+                bodies[command[1]] = (fname, command[2], body)
+            elif body is not None:
+                body.append(command)
+    return bodies
+
+
+def can_inline(body):
+    # leaves only. pop pointer is refused because a real return would
+    # restore THIS/THAT and an inlined one does not
+    for c_type, arg1, arg2 in body:
+        if c_type == Ctypes.C_CALL:
+            return False
+        if c_type == Ctypes.C_POP and arg1 == "pointer":
+            return False
+    return True
+
+
+def inline_body(callee, n_args, n_vars, body, site):
+    # argument i and local j become inline i and inline n_args + j, labels
+    # are renamed per call site and every return ends the inlined code
+    prefix = f"{callee}.inline{site}"
+    end = f"{prefix}$return"
+    s = [(Ctypes.C_INLINE_ENTER, None, n_args)] + [(Ctypes.C_PUSH, "constant", 0)] * n_vars
+    for c_type, arg1, arg2 in body:
+        if c_type in (Ctypes.C_PUSH, Ctypes.C_POP) and arg1 in ("argument", "local"):
+            s.append((c_type, "inline", arg2 if arg1 == "argument" else n_args + arg2))
+        elif c_type in (Ctypes.C_LABEL, Ctypes.C_GOTO, Ctypes.C_IF):
+            s.append((c_type, f"{prefix}.{arg1}", arg2))
+        elif c_type == Ctypes.C_RETURN:
+            s += [(Ctypes.C_INLINE_RETURN, None, None), (Ctypes.C_GOTO, end, None)]
+        else:
+            s.append((c_type, arg1, arg2))
+    if s[-1] == (Ctypes.C_GOTO, end, None):
+        s.pop()
+    if (Ctypes.C_GOTO, end, None) in s:
+        s.append((Ctypes.C_LABEL, end, None))
+    return s
+
+
+def inline_functions(files, max_size=16, budget=2000):
+    # replaces calls to leaf functions of at most max_size commands with
+    # their body, until budget more VM commands have been added. returns the
+    # new files and the number of inlined calls per function
+    bodies = function_bodies(files)
+    leaves = {name for name, (_, _, body) in bodies.items() if len(body) <= max_size and can_inline(body)}
+    inlined = collections.Counter()
+    site = 0
+    result = []
+    for fname, commands in files:
+        out = []
+        for command in commands:
+            c_type, callee, n_args = command
+            if c_type == Ctypes.C_CALL and callee in leaves:
+                callee_file, n_vars, body = bodies[callee]
+                cost = len(body) + n_vars
+                ok = cost <= budget
+                for b_type, arg1, arg2 in body:
+                    if arg1 == "static" and callee_file != fname:
+                        ok = False  # statics are named after the file being translated
+                    elif arg1 == "argument" and b_type in (Ctypes.C_PUSH, Ctypes.C_POP) and arg2 >= n_args:
+                        ok = False
+                if ok:
+                    out += inline_body(callee, n_args, n_vars, body, site)
+                    site += 1
+                    budget -= cost
+                    inlined[callee] += 1
+                    continue
+            out.append(command)
+        result.append((fname, out))
+    return result, inlined
+
+
+def translate(code_writer, commands, optimize=False):
+    if optimize:
+        n = len(commands)
+        commands = fold_constants(commands)
+        code_writer.stats["folded"] += n - len(commands)
+    i = 0
+    n = len(commands)
+    hot = loop_mask(commands) if code_writer.shared_cmp else bytearray(n)
+    while i < n:
+        c_type, arg1, arg2 = commands[i]
+        code_writer.hot = bool(hot[i])
+        if optimize and c_type == Ctypes.C_PUSH and i + 1 < n:
+            # push x; pop y  and  push x; op; pop y
+            n_type, n_arg1, n_arg2 = commands[i + 1]
+            if n_type == Ctypes.C_POP:
+                code_writer.write_push_pop(arg1, arg2, n_arg1, n_arg2)
+                i += 2
+                continue
+            if n_type == Ctypes.C_ARITHMETIC and (n_arg1 in map_bi_op or n_arg1 in map_si_op) \
+                    and i + 2 < n and commands[i + 2][0] == Ctypes.C_POP:
+                code_writer.write_push_op_pop(arg1, arg2, n_arg1, commands[i + 2][1], commands[i + 2][2])
+                i += 3
+                continue
+            if n_type == Ctypes.C_ARITHMETIC and n_arg1 in map_si_op and arg1 == "constant":
+                # push constant k; not  is how folded constants above 32767 come out
+                code_writer.write_push_const_op(arg2, n_arg1)
+                i += 2
+                continue
+        if optimize and c_type == Ctypes.C_ARITHMETIC and arg1 in map_cmp_op:
+            # eq/gt/lt [not] if-goto
+            j = i + 1
+            negate = j < n and commands[j][:2] == (Ctypes.C_ARITHMETIC, "not")
+            if negate:
+                j += 1
+            if j < n and commands[j][0] == Ctypes.C_IF:
+                code_writer.write_cmp_if_goto(arg1, negate, commands[j][1])
+                i = j + 1
+                continue
+        if code_writer.tail_calls and c_type == Ctypes.C_CALL and i + 1 < n and commands[i + 1][0] == Ctypes.C_RETURN:
+            # call f n; return
+            code_writer.write_tail_call(arg1, arg2)
+            i += 2
+            continue
+        map_write_command[c_type](code_writer, arg1, arg2)
+        i += 1
+
+
+def translate_file(file_name, commands, options):
+    # one file on its own, for the -j workers. returns the asm text and the
+    # stats that decide which shared routines the program needs
+    out = io.StringIO()
+    code_writer = CodeWriter(out, shared_frames=options["shared_frames"], shared_cmp=options["shared_cmp"],
+                             tos=options["tos"], scoped=True, tail_calls=options["tail_calls"])
+    code_writer.set_filename(file_name)
+    translate(code_writer, commands, options["optimize"])
+    code_writer.set_filename(None)  # spills a cached top of stack
+    code_writer.flush()
+    return out.getvalue(), code_writer.stats
+
+
+def file_key(file_name, commands, options):
+    # the fragment of a file depends on its name (statics), its commands
+    # and the translator options
+    text = repr((CACHE_VERSION, file_name, commands, sorted(options.items())))
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+def load_cache(cache_path):
+    try:
+        with open(cache_path, "rb") as f:
+            cache = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    if cache.get("version") != CACHE_VERSION:
+        return None
+    return cache
+
+
+def translate_files(files, options, jobs=0, cache_path=None):
+    # (asm text, stats) per file, in the order of files. files found in the
+    # cache are not translated again.
+    keys = [file_key(fname, commands, options) for fname, commands in files]
+    cached = {}
+    if cache_path:
+        cached = (load_cache(cache_path) or {"fragments": {}})["fragments"]
+    todo = [i for i, key in enumerate(keys) if key not in cached]
+
+    results = {}
+    if jobs:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+            futures = {i: pool.submit(translate_file, *files[i], options) for i in todo}
+            for i, future in futures.items():
+                results[i] = future.result()
+    else:
+        for i in todo:
+            results[i] = translate_file(*files[i], options)
+
+    fragments = [results[i] if i in results else cached[keys[i]] for i in range(len(files))]
+    if cache_path:
+        print(f"cache: {len(files) - len(todo)} of {len(files)} files reused")
+        with open(cache_path, "wb") as f:
+            pickle.dump({"version": CACHE_VERSION,
+                         "fragments": dict(zip(keys, fragments))}, f)
+    return fragments
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('file_dir')
+    parser.add_argument('-O', dest='optimize', action='store_true',
+                        help="fold constant arithmetic and identities, and fuse push/pop, push/op/pop, "
+                             "push constant/neg|not and compare/if-goto windows (tail calls are --tail-calls)")
+    parser.add_argument('--shared-frames', action='store_true',
+                        help="calls and returns jump to one shared routine each (smaller ROM, more cycles)")
+    parser.add_argument('--shared-cmp', action='store_true',
+                        help="eq/gt/lt outside of loops call one shared routine per comparison (not with --tos)")
+    parser.add_argument('--tos', action='store_true',
+                        help="keep the top of the stack in D between commands")
+    parser.add_argument('--tail-calls', action='store_true',
+                        help="call f n; return reuses the current frame through one shared routine")
+    parser.add_argument('--inline', action='store_true',
+                        help="inline calls to small leaf functions (the inline segment base is kept in R14)")
+    parser.add_argument('--inline-size', type=int, default=16,
+                        help="largest function --inline inlines, in VM commands")
+    parser.add_argument('--inline-budget', type=int, default=2000,
+                        help="stop inlining once this many VM commands have been added")
+    parser.add_argument('--prune', action='store_true',
+                        help="translate only the functions reachable from Sys.init (directory mode)")
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+                        help="translate files in N worker processes (Sys.vm first, then sorted by name)")
+    parser.add_argument('--incremental', action='store_true',
+                        help="reuse the output of unchanged files from a cache next to the output")
+    parser.add_argument('--hack', action='store_true',
+                        help="write the .hack binary directly instead of .asm")
+    parser.add_argument('--dump-asm', action='store_true',
+                        help="with --hack, also write the .asm")
     args = parser.parse_args()
     file_dir = pathlib.Path(args.file_dir)
 
@@ -333,46 +1198,55 @@ def main():
     else:
         raise NotImplementedError
 
+    scoped = bool(args.jobs or args.incremental)
+    if scoped:
+        lst_vm = sorted(lst_vm, key=lambda p: (p.parts[-1] != "Sys.vm", p.parts[-1]))
     print("vm files ", lst_vm)
     print("output: ", asm_out_path, asm_out_name)
 
-    with open(asm_out_path, 'w') as g:
-        code_writer = CodeWriter(g)
+    files = [(fname.parts[-1].split(".")[0], read_commands(fname)) for fname in lst_vm]
+    if args.inline:
+        files, inlined = inline_functions(files, args.inline_size, args.inline_budget)
+        print(f"inlined {sum(inlined.values())} calls")
+        for func_name, count in sorted(inlined.items()):
+            print("  ", func_name, count)
+    if args.prune and do_bootstrap:
+        files, dropped = prune_functions(files)
+        print(f"pruned {len(dropped)} unreachable functions")
+        for func_name in dropped:
+            print("  ", func_name)
+
+    if args.hack:
+        hack_out_path = asm_out_path[:-len(".asm")] + ".hack"
+        print("binary: ", hack_out_path)
+        out = RomWriter(hack_out_path, open(asm_out_path, 'w') if args.dump_asm else None)
+    else:
+        out = open(asm_out_path, 'w')
+
+    with out as g:
+        code_writer = CodeWriter(g, shared_frames=args.shared_frames, shared_cmp=args.shared_cmp, tos=args.tos,
+                                 scoped=scoped, tail_calls=args.tail_calls)
 
         if do_bootstrap:
             code_writer.bootstrap()
 
-        for fname in lst_vm:
-            with open(fname, 'r')as f:
-                vm_parser = VMParser(f)
-                code_writer.set_filename(fname.parts[-1].split(".")[0])
-
-                while vm_parser.has_more_lines():
-                    vm_parser.advance()
-                    vm_parser.strip_comment()
-                    if vm_parser.vm_comm:
-                        vm_parser.parse()
-                        # vm_parser.print_command()
-                        if vm_parser.command_type == Ctypes.C_PUSH:
-                            code_writer.write_push(vm_parser.arg1, vm_parser.arg2)
-                        elif vm_parser.command_type == Ctypes.C_POP:
-                            code_writer.write_pop(vm_parser.arg1, vm_parser.arg2)
-                        elif vm_parser.command_type == Ctypes.C_ARITHMETIC:
-                            code_writer.write_arithmetic(vm_parser.arg1)
-                        elif vm_parser.command_type == Ctypes.C_RETURN:
-                            code_writer.write_return()
-                        elif vm_parser.command_type == Ctypes.C_CALL:
-                            code_writer.write_call(vm_parser.arg1, vm_parser.arg2)
-                        elif vm_parser.command_type == Ctypes.C_FUNCTION:
-                            code_writer.write_function(vm_parser.arg1, vm_parser.arg2)
-                        elif vm_parser.command_type == Ctypes.C_GOTO:
-                            code_writer.write_goto(vm_parser.arg1)
-                        elif vm_parser.command_type == Ctypes.C_IF:
-                            code_writer.write_if_goto(vm_parser.arg1)
-                        elif vm_parser.command_type == Ctypes.C_LABEL:
-                            code_writer.write_label(vm_parser.arg1)
-                        else:
-                            raise NotImplementedError
+        if scoped:
+            options = {"shared_frames": args.shared_frames, "shared_cmp": args.shared_cmp,
+                       "tos": args.tos, "optimize": args.optimize, "tail_calls": args.tail_calls}
+            cache_path = asm_out_path + ".cache" if args.incremental else None
+            code_writer.flush()  # the bootstrap goes before the fragments
+            # merged in file order, whatever order the workers finish in
+            for text, stats in translate_files(files, options, args.jobs, cache_path):
+                g.write(text)
+                code_writer.stats.update(stats)
+        else:
+            for fname, commands in files:
+                code_writer.set_filename(fname)
+                translate(code_writer, commands, args.optimize)
+        code_writer.finish()
+
+    for line in code_writer.report():
+        print(line)
 
 
 if __name__ == "__main__":